@@ -239,13 +239,51 @@ class DataBufferClient(BaseClient):
 
     def _do_add_protobuf(self, func, proto, channel, robot_timestamp, write_sync):
         """Internal blob stub call, serializes proto and logs as blob."""
-        binary_data = proto.SerializeToString()
-        robot_timestamp = robot_timestamp or self.now_in_robot_basis(proto=proto)
-        type_id = proto.DESCRIPTOR.full_name
-        channel = channel or type_id
-        return func(data=binary_data, type_id=type_id, channel=channel,
+        blob = self.make_protobuf_blob(proto, channel, robot_timestamp)
+        robot_timestamp = blob.timestamp if blob.HasField('timestamp') else None
+        return func(data=blob.data, type_id=blob.type_id, channel=blob.channel,
                     robot_timestamp=robot_timestamp, write_sync=write_sync)
 
+    def add_data_blobs(self, blobs, write_sync=False, **kwargs):
+        """Log several data blobs to the data buffer in a single RPC.
+
+        Args:
+            blobs (List[DataBlob]): Sequence of DataBlob protos, e.g. from make_protobuf_blob.
+            write_sync (bool): Whether the data buffer should write the blobs synchronously.
+
+        Raises:
+            RpcError: Problem communicating with the robot.
+        """
+        return self._do_add_data_blobs(self.call, blobs, write_sync, **kwargs)
+
+    def add_data_blobs_async(self, blobs, write_sync=False, **kwargs):
+        """Async version of add_data_blobs."""
+        return self._do_add_data_blobs(self.call_async, blobs, write_sync, **kwargs)
+
+    def _do_add_data_blobs(self, func, blobs, write_sync, **kwargs):
+        """Internal multi-blob RPC stub call."""
+        request = data_buffer_protos.RecordDataBlobsRequest()
+        request.blob_data.extend(blobs)  # pylint: disable=no-member
+        request.sync = write_sync
+        return func(self._stub.RecordDataBlobs, request, value_from_response=None,
+                    error_from_response=common_header_errors, **kwargs)
+
+    def make_protobuf_blob(self, proto, channel=None, robot_timestamp=None):
+        """Serialize a protobuf message into a DataBlob for use with add_data_blobs.
+
+        Args:
+          proto (Protobuf message): Serializable protobuf to log.
+          channel (string): Name of channel for data.  If not set defaults to proto type name.
+          robot_timestamp (google.protobuf.Timestamp): Time of proto, in *robot time*.
+
+        Returns:
+            A DataBlob proto holding the serialized message.
+        """
+        type_id = proto.DESCRIPTOR.full_name
+        return data_buffer_protos.DataBlob(
+            timestamp=robot_timestamp or self.now_in_robot_basis(proto=proto),
+            channel=channel or type_id, type_id=type_id, data=proto.SerializeToString())
+
     def add_events(self, events, **kwargs):
         """Log event messages to the robot.
 
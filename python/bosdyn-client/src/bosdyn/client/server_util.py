@@ -6,10 +6,13 @@
 
 """Helper functions and classes for creating and running a gRPC service."""
 
-import copy
+import asyncio
+import functools
 import logging
+import operator
+import os
 import signal
-import time
+import threading
 from concurrent import futures
 
 import grpc
@@ -18,10 +21,142 @@ import bosdyn.util
 from bosdyn.api import (data_acquisition_store_pb2, data_buffer_pb2, header_pb2, image_pb2,
                         local_grid_pb2, log_annotation_pb2)
 from bosdyn.client.channel import generate_channel_options
+from bosdyn.client.exceptions import Error
 
 _LOGGER = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _channel_name(channel_prefix, message_type):
+    """Returns the data buffer channel for a message type, or None if there is no prefix."""
+    if channel_prefix is None:
+        return None
+    return channel_prefix + "/" + message_type.DESCRIPTOR.full_name
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_channel_options(max_send_message_length, max_receive_message_length):
+    """Returns the server channel options as a tuple, shared by runners with the same limits."""
+    return tuple(generate_channel_options(max_send_message_length, max_receive_message_length))
+
+
+class RpcLogBatcher(object):
+    """Collects logged gRPC messages and sends them to the data buffer in batches.
+
+    Messages are serialized when they are added, and a background thread sends everything
+    collected so far in a single RecordDataBlobs RPC every flush period, or sooner once
+    max_batch_size messages or max_batch_bytes of data are waiting. Share one batcher between the
+    ResponseContexts of a service to reduce the number of data buffer RPCs made under load.
+
+    Args:
+        rpc_logger (DataBufferClient): Data buffer client to log the messages with.
+        max_batch_size (int): Number of waiting messages that triggers an immediate send.
+        max_batch_bytes (int): Amount of waiting message data (bytes) that triggers an immediate
+            send. Each RPC also carries at most this much data, unless a single message is larger,
+            so keep it well below the channel's max message length (100 MB by default).
+        flush_period_secs (float): Maximum time messages wait before being sent.
+    """
+
+    def __init__(self, rpc_logger, max_batch_size=10, max_batch_bytes=16 * 1024 * 1024,
+                 flush_period_secs=0.1):
+        self.rpc_logger = rpc_logger
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_period_secs = flush_period_secs
+        self._lock = threading.Lock()
+        self._blobs = []
+        self._num_bytes = 0
+        # Set under the lock by close(); afterwards blobs are sent directly instead of queued.
+        self._closed = False
+        # Event to trigger immediate send of the waiting messages.
+        self._flush_event = threading.Event()
+        # Set to stop the send thread.
+        self._shutdown_event = threading.Event()
+        self._send_thread = threading.Thread(target=self._run_send_thread)
+        self._send_thread.daemon = True
+        self._send_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_protobuf(self, proto, channel=None):
+        """Queue a protobuf message to be logged with the next batch."""
+        self.add_data_blobs([self.rpc_logger.make_protobuf_blob(proto, channel)])
+
+    def add_data_blobs(self, blobs):
+        """Queue already serialized DataBlob protos to be logged with the next batch.
+
+        After close(), the blobs are sent immediately in their own RPC instead.
+        """
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._blobs.extend(blobs)
+                self._num_bytes += sum(len(blob.data) for blob in blobs)
+                send_now = (len(self._blobs) >= self.max_batch_size or
+                            self._num_bytes >= self.max_batch_bytes)
+        if closed:
+            self._send_blobs(blobs)
+        elif send_now:
+            self._flush_event.set()
+
+    def flush(self):
+        """Wake the send thread to send the waiting messages immediately."""
+        self._flush_event.set()
+
+    def close(self):
+        """Stop the send thread and send any remaining messages."""
+        with self._lock:
+            self._closed = True
+        self._shutdown_event.set()
+        self._flush_event.set()
+        self._send_thread.join()
+        self._send_batch()
+
+    def _send_batch(self):
+        with self._lock:
+            to_send = self._blobs
+            self._blobs = []
+            self._num_bytes = 0
+        if to_send:
+            self._send_blobs(to_send)
+
+    def _send_blobs(self, blobs):
+        """Sends the blobs in as few RPCs as possible while keeping each under max_batch_bytes."""
+        batch = []
+        batch_bytes = 0
+        for blob in blobs:
+            blob_bytes = len(blob.data)
+            if batch and batch_bytes + blob_bytes > self.max_batch_bytes:
+                self._send_rpc(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(blob)
+            batch_bytes += blob_bytes
+        if batch:
+            self._send_rpc(batch)
+
+    def _send_rpc(self, blobs):
+        try:
+            self.rpc_logger.add_data_blobs_async(blobs)
+        # Catch all client library errors.
+        except Error:
+            _LOGGER.exception('Failed to log %d messages to the data buffer.', len(blobs))
+
+    def _run_send_thread(self):
+        while not self._shutdown_event.is_set():
+            self._flush_event.wait(self.flush_period_secs)
+            self._flush_event.clear()
+            try:
+                self._send_batch()
+            except Exception:  # pylint: disable=broad-except
+                # Keep the thread alive, otherwise queued messages would grow without bound.
+                _LOGGER.exception('Unexpected error logging messages to the data buffer.')
+
+
 class ResponseContext(object):
     """Helper to log gRPC request and response message to the data buffer for a service.
 
@@ -34,48 +169,59 @@ class ResponseContext(object):
         response (protobuf): any gRPC response message with a bosdyn.api.ResponseHeader proto.
         request (protobuf): any gRPC request message with a bosdyn.api.RequestHeader proto.
         rpc_logger (DataBufferClient): Optional data buffer client to log the messages; if not
-            provided, only the headers will be mutated and nothing will be logged.
+            provided, only the headers will be mutated and nothing will be logged. It must provide
+            make_protobuf_blob and add_data_blobs_async: the request and response are sent
+            together in one RecordDataBlobs RPC, which can be up to twice the size of either
+            message, so keep both well below the channel's max message length.
         channel_prefix (string): the prefix you want this req / resp pair logged under.
         exc_callback (function): called with exception type, value, and traceback info if an
             exception is raised in the body of the "with" statement.
+        batcher (RpcLogBatcher): Optional batcher to log the messages through instead of sending
+            each one directly with rpc_logger.
     """
 
-    def __init__(self, response, request, rpc_logger=None, channel_prefix=None, exc_callback=None):
+    def __init__(self, response, request, rpc_logger=None, channel_prefix=None, exc_callback=None,
+                 batcher=None):
         self.response = response
-        self.response.header.request_header.CopyFrom(request.header)
         self.request = request
         self.rpc_logger = rpc_logger
         self.channel_prefix = channel_prefix
         self.exc_callback = exc_callback
+        self.batcher = batcher
+        self._req_channel = _channel_name(channel_prefix, type(request))
+        self._resp_channel = _channel_name(channel_prefix, type(response))
+        self._req_blob = None
 
     def __enter__(self):
-        """Adds a start timestamp to the response header and logs the request RPC."""
-        self.response.header.request_received_timestamp.CopyFrom(bosdyn.util.now_timestamp())
-        if self.rpc_logger:
-            if self.channel_prefix is None:
-                channel = None
-            else:
-                channel = self.channel_prefix + "/" + self.request.DESCRIPTOR.full_name
-            self.rpc_logger.add_protobuf_async(self.request, channel)
+        """Adds the request header and start timestamp to the response and captures the request."""
+        self.response.header.request_header.CopyFrom(self.request.header)
+        bosdyn.util.set_timestamp_from_now(self.response.header.request_received_timestamp)
+        # Serialize and timestamp the request now, but log it together with the response.
+        logger = self.batcher.rpc_logger if self.batcher else self.rpc_logger
+        if logger:
+            self._req_blob = logger.make_protobuf_blob(self.request, self._req_channel)
         return self.response
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Updates the header code if unset and logs the response RPC."""
+        """Updates the header code if unset and logs the request and response RPCs."""
         if self.response.header.error.code == self.response.header.error.CODE_UNSPECIFIED:
             self.response.header.error.code = self.response.header.error.CODE_OK
         if exc_type is not None:
             # An uncaught exception was raised by the service. Automatically set the header
-            # to be an internal error.
+            # to be an internal error. The message is set even when nothing is logged, since it
+            # is also returned to the client in the response.
             self.response.header.error.code = self.response.header.error.CODE_INTERNAL_SERVER_ERROR
             self.response.header.error.message = "[%s] %s" % (exc_type.__name__, exc_val)
             if self.exc_callback:
                 self.exc_callback(exc_type, exc_val, exc_tb)
-        if self.rpc_logger:
-            if self.channel_prefix is None:
-                channel = None
-            else:
-                channel = self.channel_prefix + "/" + self.response.DESCRIPTOR.full_name
-            self.rpc_logger.add_protobuf_async(self.response, channel)
+        if self._req_blob is None:
+            return
+        logger = self.batcher.rpc_logger if self.batcher else self.rpc_logger
+        blobs = [self._req_blob, logger.make_protobuf_blob(self.response, self._resp_channel)]
+        if self.batcher:
+            self.batcher.add_data_blobs(blobs)
+        else:
+            self.rpc_logger.add_data_blobs_async(blobs)
 
 
 class GrpcServiceRunner(object):
@@ -88,31 +234,84 @@ class GrpcServiceRunner(object):
             attaches the servicer to the gRPC server.
         port (int): The port number the service can be accessed through on the host system.
             Defaults to 0, which will assign an ephemeral port.
+        max_workers (int): Number of worker threads used to handle RPCs when no executor is given.
         max_send_message_length (int): Max message length (bytes) allowed for messages sent.
         max_receive_message_length (int): Max message length (bytes) allowed for messages received.
         timeout_secs (int): Number of seconds to wait for a clean server shutdown.
         force_sigint_capture (bool): Re-assign the SIGINT handler to default in order to prevent
             other scripts from blocking a clean exit. Defaults to True.
         logger (logging.Logger): Logger to log with.
+        executor (concurrent.futures.Executor): Executor to handle RPCs with. Defaults to a
+            ThreadPoolExecutor with max_workers threads. Unused if use_aio is True.
+        use_aio (bool): Run a grpc.aio server on an asyncio event loop in a background thread
+            instead of handling each RPC on a worker thread. The servicer methods must then be
+            coroutines ("async def"). Defaults to False.
     """
 
     def __init__(self, service_servicer, add_servicer_to_server_fn, port=0, max_workers=4,
                  max_send_message_length=None, max_receive_message_length=None, timeout_secs=3,
-                 force_sigint_capture=True, logger=None):
+                 force_sigint_capture=True, logger=None, executor=None, use_aio=False):
         self.logger = logger or _LOGGER
         self.timeout_secs = timeout_secs
         self.force_sigint_capture = force_sigint_capture
+        # Set by stop() so that run_until_interrupt returns if another thread stops the server.
+        self._stop_event = threading.Event()
 
         # Use the name of the service_servicer class for print messages.
         self.server_type_name = type(service_servicer).__name__
 
-        self.server = grpc.server(
-            futures.ThreadPoolExecutor(max_workers=max_workers),
-            options=generate_channel_options(max_send_message_length, max_receive_message_length))
-        add_servicer_to_server_fn(service_servicer, self.server)
-        self.port = self.server.add_insecure_port('[::]:{}'.format(port))
-        self.server.start()
-        self.logger.info('Started the {} server.'.format(self.server_type_name))
+        options = _cached_channel_options(max_send_message_length, max_receive_message_length)
+        self._loop = None
+        self._loop_thread = None
+        if use_aio:
+            self._loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(
+                target=self._loop.run_forever, name=self.server_type_name + ' event loop',
+                daemon=True)
+            self._loop_thread.start()
+            try:
+                self.server, self.port = self._run_in_loop(
+                    self._start_aio_server(service_servicer, add_servicer_to_server_fn, port,
+                                           options))
+            except BaseException:
+                self._shutdown_loop()
+                raise
+        else:
+            if executor is None:
+                executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+            self.server = grpc.server(executor, options=options)
+            add_servicer_to_server_fn(service_servicer, self.server)
+            self.port = self.server.add_insecure_port('[::]:{}'.format(port))
+            self.server.start()
+        self.logger.info('Started the %s server.', self.server_type_name)
+
+    @staticmethod
+    async def _start_aio_server(service_servicer, add_servicer_to_server_fn, port, options):
+        """Creates and starts a grpc.aio server; must run on the runner's event loop."""
+        server = grpc.aio.server(options=options)
+        add_servicer_to_server_fn(service_servicer, server)
+        bound_port = server.add_insecure_port('[::]:{}'.format(port))
+        await server.start()
+        return server, bound_port
+
+    def _run_in_loop(self, coroutine, timeout=None):
+        """Runs a coroutine on the runner's event loop and blocks until it completes."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def _shutdown_loop(self):
+        """Stops the runner's event loop and thread, cancels any pending tasks and closes it."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(self.timeout_secs)
+        if self._loop_thread.is_alive():
+            return
+        # Let tasks left behind, e.g. a timed out server stop, finish cancelling before the loop
+        # is closed so that they are not destroyed while pending.
+        pending = asyncio.all_tasks(self._loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
 
     def __enter__(self):
         return self
@@ -122,28 +321,48 @@ class GrpcServiceRunner(object):
 
     def stop(self):
         """Blocks until the gRPC server shuts down."""
-        self.logger.info("Shutting down the {} server.".format(self.server_type_name))
-        shutdown_complete = self.server.stop(None)
-        shutdown_complete.wait(self.timeout_secs)
+        self._stop_event.set()
+        self.logger.info('Shutting down the %s server.', self.server_type_name)
+        if self._loop is None:
+            shutdown_complete = self.server.stop(None)
+            shutdown_complete.wait(self.timeout_secs)
+            return
+        if self._loop.is_closed():
+            return
+        try:
+            self._run_in_loop(self.server.stop(None), self.timeout_secs)
+        except futures.TimeoutError:
+            self.logger.warning('Timed out shutting down the %s server.', self.server_type_name)
+        self._shutdown_loop()
 
     def run_until_interrupt(self):
-        """Spin the thread until a SIGINT is received and then shut down cleanly."""
+        """Block the thread until a SIGINT is received and then shut down cleanly.
+
+        Also returns if stop() is called from another thread.
+        """
         if self.force_sigint_capture:
             # Ensure that KeyboardInterrupt is raised on a SIGINT.
             signal.signal(signal.SIGINT, signal.default_int_handler)
 
-        # Monitor for SIGINT and shut down cleanly.
+        # A signal interrupts a blocking wait on POSIX. Elsewhere handlers only run between
+        # bytecodes, so wake up periodically to let them run.
+        wait_timeout = None if os.name == 'posix' else 1
         try:
-            while True:
-                time.sleep(1)
+            while not self._stop_event.wait(wait_timeout):
+                pass
         except KeyboardInterrupt:
-            pass
-        self.stop()
+            self.stop()
 
 
 def populate_response_header(response, request, error_code=header_pb2.CommonError.CODE_OK,
                              error_msg=None):
     """Sets the ResponseHeader header in the response.
+
+    The request is packed into the header with its large bytes fields stripped. For request types
+    in the bytes field allowlist, those fields are cleared on the request itself while it is
+    packed and restored afterwards, so this is not thread-safe against other threads reading the
+    request at the same time.
+
     Args:
         response (bosdyn.api Response message): The GRPC response message to be populated.
         request (bosdyn.api Request message): The header from the request is added to the response.
@@ -152,80 +371,144 @@ def populate_response_header(response, request, error_code=header_pb2.CommonErro
     Returns:
         Mutates the response message's header to be fully populated.
     """
-    header = header_pb2.ResponseHeader()
-    header.request_received_timestamp.CopyFrom(bosdyn.util.now_timestamp())
+    header = response.header
+    header.Clear()
+    bosdyn.util.set_timestamp_from_now(header.request_received_timestamp)
     header.request_header.CopyFrom(request.header)
     header.error.code = error_code
     if error_msg:
         header.error.message = error_msg
-    copied_request = copy.copy(request)
-    strip_large_bytes_fields(copied_request)
-    header.request.Pack(copied_request)
-    response.header.CopyFrom(header)
+    # Temporarily detach the large bytes fields rather than packing a full copy of the request.
+    stripped_fields = strip_large_bytes_fields(request)
+    try:
+        _pack_any(header.request, request)
+    finally:
+        restore_large_bytes_fields(stripped_fields)
 
 
-def strip_large_bytes_fields(proto_message):
-    """Removes any large bytes fields from a protobuf message depending on the proto type."""
+# Any type_url of each packed message type, keyed by the message class.
+_TYPE_URL_CACHE = {}
+
+
+def _pack_any(any_proto, proto_message):
+    """Equivalent of any_proto.Pack(proto_message) that reuses the type_url for each type."""
     message_type = type(proto_message)
-    allowlist_map = get_bytes_field_allowlist()
-    if message_type in allowlist_map:
-        allowlist_map[message_type](proto_message)
+    type_url = _TYPE_URL_CACHE.get(message_type)
+    if type_url is None:
+        type_url = 'type.googleapis.com/' + proto_message.DESCRIPTOR.full_name
+        _TYPE_URL_CACHE[message_type] = type_url
+    any_proto.type_url = type_url
+    any_proto.value = proto_message.SerializeToString()
+
+
+def strip_large_bytes_fields(proto_message):
+    """Removes any large bytes fields from a protobuf message depending on the proto type.
+
+    Returns:
+        A list of (message, bytes) tuples for the fields that were cleared, which can be passed to
+        restore_large_bytes_fields to undo the stripping. None if the proto type has no
+        large bytes fields.
+    """
+    strip_fn = _BYTES_FIELD_ALLOWLIST.get(type(proto_message))
+    if strip_fn is None:
+        return None
+    return strip_fn(proto_message)
+
+
+def restore_large_bytes_fields(stripped_fields):
+    """Restores the bytes fields removed by strip_large_bytes_fields.
+
+    Args:
+        stripped_fields (list): The (message, bytes) tuples returned by a strip function.
+    """
+    if not stripped_fields:
+        return
+    for proto_message, data in stripped_fields:
+        proto_message.data = data
 
 
 def get_bytes_field_allowlist():
-    """Creates set of protos which will have bytes fields removed."""
-    allowlist_map = {
-        image_pb2.GetImageResponse: strip_get_image_response,
-        local_grid_pb2.GetLocalGridsResponse: strip_local_grid_responses,
-        data_acquisition_store_pb2.StoreDataRequest: strip_store_data_request,
-        data_acquisition_store_pb2.StoreImageRequest: strip_store_image_request,
-        data_buffer_pb2.RecordSignalTicksRequest: strip_record_signal_tick,
-        data_buffer_pb2.RecordDataBlobsRequest: strip_record_data_blob,
-        log_annotation_pb2.AddLogAnnotationRequest: strip_log_annotation
-    }
-    return allowlist_map
+    """Returns the map of protos which will have bytes fields removed to their strip function."""
+    return _BYTES_FIELD_ALLOWLIST
+
+
+def _strip_data_fields(proto_messages):
+    """Clears the "data" field of each message which has one set.
+
+    Empty fields are skipped, which avoids needless work for metadata-only and error messages and
+    never marks an unset parent submessage as present.
+
+    Returns:
+        A list of (message, bytes) tuples for the fields that were cleared.
+    """
+    stripped_fields = []
+    for proto_message in proto_messages:
+        data = proto_message.data
+        if data:
+            # Assigning the default value is cheaper than ClearField for a scalar bytes field.
+            proto_message.data = b""
+            stripped_fields.append((proto_message, data))
+    return stripped_fields
+
+
+# Accessors for the bytes-holding submessages of the high-volume repeated responses. attrgetter
+# walks the attribute chain in C rather than in the interpreter.
+_get_image_response_image = operator.attrgetter("shot.image")
+_get_local_grid_response_grid = operator.attrgetter("local_grid")
 
 
 def strip_image_response(proto_message):
     """Removes bytes from the image_pb2.ImageResponse proto."""
-    proto_message.shot.image.ClearField("data")
+    return _strip_data_fields((proto_message.shot.image,))
 
 
 def strip_get_image_response(proto_message):
     """Removes bytes from the image_pb2.GetImageResponse proto."""
-    for img_resp in proto_message.image_responses:
-        strip_image_response(img_resp)
+    return _strip_data_fields(map(_get_image_response_image, proto_message.image_responses))
 
 
 def strip_local_grid_responses(proto_message):
     """Removes bytes from the local_grid_pb2.GetLocalGridsResponse proto."""
-    for grid_resp in proto_message.local_grid_responses:
-        grid_resp.local_grid.ClearField("data")
+    return _strip_data_fields(
+        map(_get_local_grid_response_grid, proto_message.local_grid_responses))
 
 
 def strip_store_image_request(proto_message):
     """Removes bytes from the data_acquisition_store_pb2.StoreImageRequest proto."""
-    proto_message.image.image.ClearField("data")
+    return _strip_data_fields((proto_message.image.image,))
 
 
 def strip_store_data_request(proto_message):
     """Removes bytes from the data_acquisition_store_pb2.StoreDataRequest proto."""
-    proto_message.ClearField("data")
+    return _strip_data_fields((proto_message,))
 
 
 def strip_record_signal_tick(proto_message):
     """Removes bytes from the data_buffer_pb2.RecordSignalTicksRequest proto."""
-    for tick_data in proto_message.tick_data:
-        tick_data.ClearField("data")
+    return _strip_data_fields(proto_message.tick_data)
 
 
 def strip_record_data_blob(proto_message):
     """Removes bytes from the data_buffer_pb2.RecordDataBlobsRequest proto."""
-    for blob in proto_message.blob_data:
-        blob.ClearField("data")
+    return _strip_data_fields(proto_message.blob_data)
 
 
 def strip_log_annotation(proto_message):
     """Removes bytes from the log_annotation_pb2.AddLogAnnotationRequest proto."""
-    for blob in proto_message.annotations.blob_data:
-        blob.ClearField("data")
+    return _strip_data_fields(proto_message.annotations.blob_data)
+
+
+# Protos which will have bytes fields removed, mapped to the function that strips them.
+# A dict lookup beats a linear scan of (type, function) pairs here even when the first entry
+# matches, and is more than twice as fast for the common case of a type that is not listed.
+# It is also several times faster than a getattr() miss on a marker attribute stamped onto the
+# listed message classes, since a miss has to search the whole class hierarchy.
+_BYTES_FIELD_ALLOWLIST = {
+    image_pb2.GetImageResponse: strip_get_image_response,
+    local_grid_pb2.GetLocalGridsResponse: strip_local_grid_responses,
+    data_acquisition_store_pb2.StoreDataRequest: strip_store_data_request,
+    data_acquisition_store_pb2.StoreImageRequest: strip_store_image_request,
+    data_buffer_pb2.RecordSignalTicksRequest: strip_record_signal_tick,
+    data_buffer_pb2.RecordDataBlobsRequest: strip_record_data_blob,
+    log_annotation_pb2.AddLogAnnotationRequest: strip_log_annotation
+}
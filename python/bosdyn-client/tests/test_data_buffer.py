@@ -104,6 +104,25 @@ def test_add_protobuf(client, constant_log_timestamp):
             constant_log_timestamp)
 
 
+def test_add_data_blobs(client, constant_log_timestamp):
+    protos = [timestamp_pb2.Timestamp(seconds=1), timestamp_pb2.Timestamp(seconds=2)]
+    blobs = [client.make_protobuf_blob(protos[0]), client.make_protobuf_blob(protos[1], 'chan')]
+    assert blobs[0].channel == blobs[0].type_id == 'google.protobuf.Timestamp'
+    assert blobs[1].channel == 'chan'
+    assert blobs[1].timestamp == constant_log_timestamp
+
+    client.add_data_blobs(blobs)
+    assert client._stub.RecordDataBlobs.call_count == 1
+    request = client._stub.RecordDataBlobs.call_args[0][0]
+    assert request.sync == False
+    assert [blob.data for blob in request.blob_data] == [p.SerializeToString() for p in protos]
+
+    client.add_data_blobs_async(blobs, write_sync=True).result()
+    assert client._stub.RecordDataBlobs.future.call_count == 1
+    assert client._stub.RecordDataBlobs.future.call_args[0][0].sync == True
+    assert len(client._stub.RecordDataBlobs.future.call_args[0][0].blob_data) == 2
+
+
 def test_add_events(client):
     event = Event()
     event.type = 'test-event'
@@ -6,13 +6,23 @@
 
 """Unit tests for the server_utils module."""
 import datetime
+import os
+import signal
+import threading
 import time
+from concurrent import futures
+from unittest import mock
 
+import grpc
 import pytest
 
 from bosdyn.api import data_acquisition_store_pb2 as daq_store
+from bosdyn.api import data_buffer_pb2 as data_buffer
+from bosdyn.api import directory_pb2, directory_service_pb2_grpc
 from bosdyn.api import local_grid_pb2 as grid
-from bosdyn.client.server_util import populate_response_header, strip_large_bytes_fields
+from bosdyn.client.data_buffer import DataBufferClient
+from bosdyn.client.server_util import (GrpcServiceRunner, ResponseContext, RpcLogBatcher,
+                                       populate_response_header, strip_large_bytes_fields)
 
 
 def test_strip_large_bytes():
@@ -52,6 +62,17 @@ def test_strip_large_bytes_repeated_msg():
         assert g.local_grid.frame_name_local_grid_data == "my_frame"
 
 
+def test_strip_large_bytes_skips_empty_fields():
+    req = data_buffer.RecordDataBlobsRequest()
+    req.blob_data.add(channel="empty")
+    req.blob_data.add(channel="full", data=bytes("mybytes", 'utf-8'))
+
+    stripped_fields = strip_large_bytes_fields(req)
+
+    assert stripped_fields == [(req.blob_data[1], bytes("mybytes", 'utf-8'))]
+    assert len(req.blob_data[1].data) == 0
+
+
 def test_stripped_headers():
     request = daq_store.StoreImageRequest()
     request.header.client_name = "my_client"
@@ -68,3 +89,214 @@ def test_stripped_headers():
     assert len(req_unpacked.image.image.data) == 0
     # check that the original request is unchanged.
     assert len(request.image.image.data) > 0
+
+
+def test_populate_response_header_prepopulated():
+    request = daq_store.StoreImageRequest()
+    request.header.client_name = "my_client"
+    response = daq_store.StoreImageResponse()
+    # A stale header, e.g. from a response template, is replaced.
+    response.header.request_header.client_name = "stale_client"
+    response.header.error.message = "stale error"
+
+    populate_response_header(response, request)
+
+    assert response.header.request_header == request.header
+    assert response.header.error.code == response.header.error.CODE_OK
+    assert response.header.error.message == ""
+
+    # A header already copied from this request, e.g. by a ResponseContext, is copied again.
+    populate_response_header(response, request, error_msg="new error")
+    assert response.header.request_header == request.header
+    assert response.header.error.message == "new error"
+
+    # An empty request header is still marked present in the response.
+    response = daq_store.StoreImageResponse()
+    populate_response_header(response, daq_store.StoreImageRequest())
+    assert response.header.HasField("request_header")
+
+
+def test_stripped_headers_repeated_msg():
+    request = data_buffer.RecordDataBlobsRequest()
+    request.header.client_name = "my_client"
+    for _ in range(2):
+        request.blob_data.add(channel="my_channel", data=bytes("mybytes", 'utf-8'))
+    response = data_buffer.RecordDataBlobsResponse()
+
+    populate_response_header(response, request)
+
+    req_unpacked = data_buffer.RecordDataBlobsRequest()
+    response.header.request.Unpack(req_unpacked)
+    assert len(req_unpacked.blob_data) == 2
+    for blob in req_unpacked.blob_data:
+        assert len(blob.data) == 0
+        assert blob.channel == "my_channel"
+    # check that the original request is unchanged.
+    for blob in request.blob_data:
+        assert blob.data == bytes("mybytes", 'utf-8')
+
+
+def test_stripped_headers_unset_submessage():
+    request = daq_store.StoreImageRequest()
+    request.header.client_name = "my_client"
+    response = daq_store.StoreImageResponse()
+
+    populate_response_header(response, request)
+
+    assert not request.HasField("image")
+
+
+def test_response_context_batcher():
+    rpc_logger = DataBufferClient()
+    rpc_logger._stub = mock.Mock()
+    # Use a long flush period so that only close() sends the batch.
+    batcher = RpcLogBatcher(rpc_logger, flush_period_secs=100)
+    request = daq_store.StoreImageRequest()
+    request.header.client_name = "my_client"
+    response = daq_store.StoreImageResponse()
+
+    with ResponseContext(response, request, channel_prefix="prefix", batcher=batcher):
+        pass
+    assert response.header.error.code == response.header.error.CODE_OK
+    assert rpc_logger._stub.RecordDataBlobs.future.call_count == 0
+
+    batcher.close()
+    assert rpc_logger._stub.RecordDataBlobs.future.call_count == 1
+    blobs = rpc_logger._stub.RecordDataBlobs.future.call_args[0][0].blob_data
+    assert [blob.channel for blob in blobs] == [
+        "prefix/bosdyn.api.StoreImageRequest", "prefix/bosdyn.api.StoreImageResponse"
+    ]
+    assert blobs[0].data == request.SerializeToString()
+
+    # Messages added after close() are sent right away rather than stranded in the queue.
+    batcher.add_protobuf(request)
+    assert rpc_logger._stub.RecordDataBlobs.future.call_count == 2
+
+
+def test_rpc_log_batcher_max_batch_bytes():
+    rpc_logger = DataBufferClient()
+    rpc_logger._stub = mock.Mock()
+    batcher = RpcLogBatcher(rpc_logger, max_batch_bytes=10, flush_period_secs=100)
+    blobs = [data_buffer.DataBlob(data=bytes(6)) for _ in range(3)]
+
+    batcher.add_data_blobs(blobs)
+    batcher.close()
+
+    # 6 + 6 bytes is over the cap, so each blob goes out in its own RPC.
+    requests = [c[0][0] for c in rpc_logger._stub.RecordDataBlobs.future.call_args_list]
+    assert [len(r.blob_data) for r in requests] == [1, 1, 1]
+
+
+def test_rpc_log_batcher_survives_send_error():
+    rpc_logger = DataBufferClient()
+    rpc_logger._stub = mock.Mock()
+    rpc_logger._stub.RecordDataBlobs.future.side_effect = [RuntimeError("boom"), mock.Mock()]
+    batcher = RpcLogBatcher(rpc_logger, max_batch_size=1, flush_period_secs=0.01)
+
+    def wait_for_sends(count):
+        deadline = time.time() + 5
+        while rpc_logger._stub.RecordDataBlobs.future.call_count < count:
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    batcher.add_protobuf(daq_store.StoreImageRequest())
+    wait_for_sends(1)
+    # The send thread is still alive after the unexpected error and sends the next batch.
+    batcher.add_protobuf(daq_store.StoreImageRequest())
+    wait_for_sends(2)
+    batcher.close()
+    assert rpc_logger._stub.RecordDataBlobs.future.call_count == 2
+
+
+def test_grpc_service_runner():
+    servicer = directory_service_pb2_grpc.DirectoryServiceServicer()
+    add_fn = directory_service_pb2_grpc.add_DirectoryServiceServicer_to_server
+    with GrpcServiceRunner(servicer, add_fn, max_workers=2) as runner:
+        assert runner.port > 0
+
+    executor = futures.ThreadPoolExecutor(max_workers=2)
+    with GrpcServiceRunner(servicer, add_fn, executor=executor) as runner:
+        assert runner.port > 0
+    executor.shutdown()
+
+
+def test_grpc_service_runner_run_until_interrupt():
+    servicer = directory_service_pb2_grpc.DirectoryServiceServicer()
+    add_fn = directory_service_pb2_grpc.add_DirectoryServiceServicer_to_server
+    original_handler = signal.getsignal(signal.SIGINT)
+    try:
+        runner = GrpcServiceRunner(servicer, add_fn, max_workers=2)
+        threading.Timer(0.1, os.kill, args=(os.getpid(), signal.SIGINT)).start()
+        start = time.time()
+        runner.run_until_interrupt()
+        assert time.time() - start < 1
+        # Later SIGINTs still raise KeyboardInterrupt.
+        assert signal.getsignal(signal.SIGINT) is signal.default_int_handler
+    finally:
+        signal.signal(signal.SIGINT, original_handler)
+
+
+def test_grpc_service_runner_stop_ends_run_until_interrupt():
+    servicer = directory_service_pb2_grpc.DirectoryServiceServicer()
+    add_fn = directory_service_pb2_grpc.add_DirectoryServiceServicer_to_server
+    original_handler = signal.getsignal(signal.SIGINT)
+    try:
+        runner = GrpcServiceRunner(servicer, add_fn, max_workers=2)
+        threading.Timer(0.1, runner.stop).start()
+        start = time.time()
+        runner.run_until_interrupt()
+        assert time.time() - start < 1
+    finally:
+        signal.signal(signal.SIGINT, original_handler)
+
+
+def _event_loop_threads(server_type_name):
+    return [t for t in threading.enumerate() if t.name == server_type_name + " event loop"]
+
+
+def test_grpc_service_runner_aio():
+
+    class AsyncDirectoryServicer(directory_service_pb2_grpc.DirectoryServiceServicer):
+
+        async def ListServiceEntries(self, request, context):
+            response = directory_pb2.ListServiceEntriesResponse()
+            response.service_entries.add(name="my_service")
+            return response
+
+    add_fn = directory_service_pb2_grpc.add_DirectoryServiceServicer_to_server
+    with GrpcServiceRunner(AsyncDirectoryServicer(), add_fn, use_aio=True) as runner:
+        with grpc.insecure_channel('localhost:{}'.format(runner.port)) as channel:
+            stub = directory_service_pb2_grpc.DirectoryServiceStub(channel)
+            response = stub.ListServiceEntries(directory_pb2.ListServiceEntriesRequest(),
+                                               timeout=5)
+    assert response.service_entries[0].name == "my_service"
+    # The event loop thread is gone after stop().
+    assert not _event_loop_threads("AsyncDirectoryServicer")
+
+
+def test_grpc_service_runner_aio_failed_start():
+
+    def failing_add_fn(servicer, server):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        GrpcServiceRunner(directory_service_pb2_grpc.DirectoryServiceServicer(), failing_add_fn,
+                          use_aio=True)
+    assert not _event_loop_threads("DirectoryServiceServicer")
+
+
+def test_response_context_logs_pair():
+    rpc_logger = DataBufferClient()
+    rpc_logger._stub = mock.Mock()
+    request = daq_store.StoreImageRequest()
+    response = daq_store.StoreImageResponse()
+
+    with ResponseContext(response, request, rpc_logger):
+        assert rpc_logger._stub.RecordDataBlobs.future.call_count == 0
+
+    assert rpc_logger._stub.RecordDataBlobs.future.call_count == 1
+    blobs = rpc_logger._stub.RecordDataBlobs.future.call_args[0][0].blob_data
+    assert [blob.type_id for blob in blobs] == [
+        "bosdyn.api.StoreImageRequest", "bosdyn.api.StoreImageResponse"
+    ]
+    assert blobs[1].data == response.SerializeToString()